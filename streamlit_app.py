@@ -15,15 +15,36 @@
 # ------------------------------------------------------------
 from __future__ import annotations
 
+import io
 import re
-import json
+import time
+import hashlib
+import random
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right, insort
+from functools import lru_cache
+from itertools import accumulate
 from pathlib import Path
-from datetime import datetime, timezone, time as dt_time
-from typing import Dict, Any, List, Tuple
+from datetime import datetime, timedelta, timezone, time as dt_time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from typing import TYPE_CHECKING, Dict, Any, Callable, Iterator, List, Tuple
 
-import requests
-from requests.auth import HTTPBasicAuth
+import orjson
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+if TYPE_CHECKING:  # requests は初回のHTTP呼び出しまで読み込まない（get_http_session 参照）
+    import requests
+
+WPAuth = Tuple[str, str]  # (user, application password) → requests が Basic 認証として扱う
+
+try:  # 予約日時の入力はJSTとして扱う（サーバーのローカル時刻に依存しない）
+    _JST = ZoneInfo("Asia/Tokyo")
+except ZoneInfoNotFoundError:  # tzdata の無い環境（Windows等）向け。JSTは夏時間なしなので固定オフセットで同じ
+    _JST = timezone(timedelta(hours=9), "JST")
 
 # ==============================
 # 基本設定
@@ -43,12 +64,63 @@ GEMINI_KEY = st.secrets.get("google", {}).get("gemini_api_key_1", None)
 if not GEMINI_KEY:
     st.warning("Gemini APIキー（google.gemini_api_key_1）が未設定です。生成機能は動作しません。")
 
+GEMINI_API_ORIGIN = "https://generativelanguage.googleapis.com/"
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (AutoWriter/Streamlit)",
     "Accept": "application/json",
     "Content-Type": "application/json; charset=utf-8",
 }
 
+def _put(key: str, value: Any) -> None:
+    """値が変わった時だけ session_state に書く（再実行のたびに同じ値を書き戻さない）。"""
+    if st.session_state.get(key) != value:
+        st.session_state[key] = value
+
+# ------------------------------
+# HTTP セッション（接続プール + リトライ）
+# ------------------------------
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """WP/Gemini 共通の Session。再実行をまたいで TCP/TLS 接続を使い回す。"""
+    # urllib3 等を含めて重いので、起動時ではなく最初のHTTP呼び出し時に import
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    s = requests.Session()
+    # WP 向け：ステータス/読み取りエラーの再送は GET のみ。
+    # 投稿（POST）は冪等でなく、WP側で作成済みでも 502/タイムアウトが返りうるので再送すると二重投稿になる
+    # （接続確立前の失敗だけは urllib3 の仕様上メソッドに関係なく再試行される = 未送信なので安全）
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,  # 使い切ったら最後のレスポンスを返す（呼び出し側でステータス判定）
+        ),
+    )
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    # Gemini 向け：ステータスでは再送しない（接続確立の失敗のみ再試行）。
+    # 429 は call_gemini_stream 側で毎回 GeminiRateLimiter を通してから再送する
+    gemini_adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=3,
+            read=0,
+            status=0,
+            backoff_factor=0.3,
+            raise_on_status=False,
+        ),
+    )
+    s.mount(GEMINI_API_ORIGIN, gemini_adapter)
+    s.headers.update(HEADERS)
+    return s
+
 # ------------------------------
 # WP エンドポイント補助
 # ------------------------------
@@ -61,38 +133,142 @@ def api_candidates(base: str, route: str) -> List[str]:
     # ?rest_route= 優先（WAF回避）
     return [f"{base}?rest_route=/{route}", f"{base}wp-json/{route}"]
 
-def wp_get(base: str, route: str, auth: HTTPBasicAuth, headers: Dict[str, str]) -> requests.Response | None:
+def _route_pref() -> Dict[str, int]:
+    """サイトごとに最後に成功した api_candidates の添字（0: ?rest_route= / 1: wp-json/）。セッション内で保持。"""
+    return st.session_state.setdefault("_wp_route_pref", {})
+
+def _ordered_candidates(base: str, route: str) -> List[Tuple[int, str]]:
+    """前回成功した形式を先頭にした (添字, URL) の並び。"""
+    urls = api_candidates(base, route)
+    first = _route_pref().get(ensure_trailing_slash(base), 0)
+    return sorted(enumerate(urls), key=lambda iu: iu[0] != first)
+
+def wp_get(base: str, route: str, auth: WPAuth, headers: Dict[str, str]) -> requests.Response | None:
     last = None
-    for url in api_candidates(base, route):
-        r = requests.get(url, auth=auth, headers=headers, timeout=20)
+    for idx, url in _ordered_candidates(base, route):
+        r = get_http_session().get(url, auth=auth, headers=headers, timeout=20)
         last = r
         if r.status_code == 200:
+            _route_pref()[ensure_trailing_slash(base)] = idx
             return r
     return last
 
-def wp_post(base: str, route: str, auth: HTTPBasicAuth, headers: Dict[str, str],
+def wp_post(base: str, route: str, auth: WPAuth, headers: Dict[str, str],
             json_payload: Dict[str, Any]) -> requests.Response | None:
     last = None
-    for url in api_candidates(base, route):
-        r = requests.post(url, auth=auth, headers=headers, json=json_payload, timeout=45)
+    for idx, url in _ordered_candidates(base, route):
+        r = get_http_session().post(url, auth=auth, headers=headers, json=json_payload, timeout=45)
         last = r
         if r.status_code in (200, 201):
+            _route_pref()[ensure_trailing_slash(base)] = idx
             return r
     return last
 
-# ==== まとめ欠落の自動補完ヘルパー ====
-import re
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_wp_get(base: str, route: str, user: str, password: str) -> Tuple[int | None, str]:
+    """wp_get の結果（ステータス, 本文）を5分キャッシュ。再実行のたびにWPへ問い合わせない。"""
+    r = wp_get(base, route, (user, password), HEADERS)
+    if r is None:
+        return None, ""
+    return r.status_code, r.text
+
+CATEGORIES_ROUTE = "wp/v2/categories?per_page=100&_fields=id,name"
+CAT_OPTIONS_LIMIT = 50  # カテゴリー multiselect に一度に出す最大件数
+
+def wp_auth_key(base: str, user: str) -> str:
+    """キャッシュキー用の認証指紋（パスワードは含めない）。"""
+    return hashlib.sha1(f"{user}:{ensure_trailing_slash(base)}".encode("utf-8")).hexdigest()
+
+def _auth_from_key(auth_key: str) -> WPAuth:
+    for c in WP_CONFIGS.values():
+        if wp_auth_key(c["url"], c["user"]) == auth_key:
+            return (c["user"], c["password"])
+    raise KeyError("該当するWP接続設定がありません")
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_fetch_categories(base_url: str, auth_key: str) -> List[Tuple[str, int]]:
+    """RESTのカテゴリー一覧を10分キャッシュ。失敗時は例外にしてキャッシュさせない。"""
+    r = wp_get(base_url, CATEGORIES_ROUTE, _auth_from_key(auth_key), HEADERS)
+    if r is None or r.status_code != 200:
+        raise RuntimeError(f"categories → {r.status_code if r is not None else 'N/A'}")
+    data = r.json()  # WP はBOM付きで返すことがあるので requests 側で解析（orjson はBOM非対応）
+    pairs = [(c.get("name", "(no name)"), int(c.get("id"))) for c in data if c.get("id") is not None]
+    return sorted(pairs, key=lambda x: x[0])
+
+def fetch_categories(base_url: str, auth: WPAuth) -> Tuple[List[Tuple[str, int]], str | None]:
+    """(カテゴリー一覧, 失敗理由) を返す。失敗時は ([], 理由)。"""
+    try:
+        return _cached_fetch_categories(base_url, wp_auth_key(base_url, auth[0])), None
+    except Exception as e:
+        return [], str(e)
+
+def _resolve_cats(cfg: Dict[str, Any], site_key: str, base_url: str,
+                  auth: WPAuth) -> Tuple[List[Tuple[str, int]], str | None]:
+    """カテゴリー候補を Secrets(wp_configs) → Secrets(wp_categories) → REST の順で解決し、(名前順の一覧, 失敗理由) で返す。"""
+    cfg_cats_map: Dict[str, int] = dict(cfg.get("categories", {}))
+    if cfg_cats_map:
+        return sorted([(name, int(cid)) for name, cid in cfg_cats_map.items()], key=lambda x: x[0]), None
+    sc_map: Dict[str, int] = st.secrets.get("wp_categories", {}).get(site_key, {})
+    if sc_map:
+        return sorted([(name, int(cid)) for name, cid in sc_map.items()], key=lambda x: x[0]), None
+    return fetch_categories(base_url, auth)
+
+# ------------------------------
+# 正規表現（import 時に一度だけコンパイル）
+# ------------------------------
+_RE_H2 = re.compile(r'<h2>.*?</h2>', re.DOTALL | re.IGNORECASE)
+_RE_H2_TITLE = re.compile(r'<h2>(.*?)</h2>', re.DOTALL | re.IGNORECASE)
+_RE_H2_FAST = re.compile(r'<h2>([^<]*)</h2>', re.IGNORECASE)  # 見出し内にタグが無い通常ケース
+_RE_H3 = re.compile(r'<h3>.*?</h3>', re.DOTALL | re.IGNORECASE)
+_RE_P = re.compile(r'<p>.*?</p>', re.DOTALL | re.IGNORECASE)
+_RE_TAG = re.compile(r'</?(\w+)[^>]*>')
+_RE_BR = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_RE_STRIP_TAGS = re.compile(r'<[^>]+>')  # 遅延 .*? より後戻りが少ない
+_RE_LIST_OR_TABLE = re.compile(r'<(ul|ol|table)\b', re.IGNORECASE)
+_RE_FORBIDDEN = re.compile(r'<h4|<script|<style', re.IGNORECASE)
+_RE_HEADING_OPEN = re.compile(r'<h2>|<h3>', re.IGNORECASE)
+_RE_H2_OPEN = re.compile(r'<h2>', re.IGNORECASE)
+_RE_HAS_SUMMARY = re.compile(r'<h2>[^<]*まとめ[^<]*</h2>', re.IGNORECASE)
+_RE_SUMMARY_H2 = re.compile(r'<h2>\s*まとめ\s*</h2>', re.IGNORECASE)
+# UI（共起語の分割 / ①〜③ 出力の切り出し）
+_RE_CO_SPLIT = re.compile(r"[,\n\r]+")
+_RE_OUTLINE_READERS = re.compile(r'①[^\n]*\n(.+?)\n\n②', re.DOTALL)
+_RE_OUTLINE_NEEDS = re.compile(r'②[^\n]*\n(.+?)\n\n③', re.DOTALL)
+_RE_OUTLINE_STRUCT = re.compile(r'③[^\n]*\n(.+)$', re.DOTALL)
+
+def fold_text(s: str) -> str:
+    """照合用の正規化：NFKC で全角英数/半角カナ等をそろえ、casefold で大小を無視する。"""
+    return unicodedata.normalize("NFKC", s).casefold()
 
+# ==== まとめ欠落の自動補完ヘルパー ====
 def _has_summary(html: str) -> bool:
     """<h2>タグ内に「まとめ」を含む見出しがあるか判定（大文字小文字無視）"""
-    return bool(re.search(r'(?i)<h2>[^<]*まとめ[^<]*</h2>', html or ""))
+    return bool(_RE_HAS_SUMMARY.search(html or ""))
 
 def _extract_h2_titles(html: str):
     """本文中の <h2> タイトルを配列で返す（HTMLタグ除去、はじめに/まとめ除外）"""
-    titles = re.findall(r'(?is)<h2>(.*?)</h2>', html or "")
-    clean = [re.sub(r'<.*?>', '', t).strip() for t in titles]
+    html = html or ""
+    titles = _RE_H2_FAST.findall(html)
+    # 見出し内にタグが混じる<h2>があれば取りこぼすので、その時だけ DOTALL 版で取り直す
+    if len(titles) != len(_RE_H2_OPEN.findall(html)):
+        titles = _RE_H2_TITLE.findall(html)
+    clean = [_RE_STRIP_TAGS.sub('', t).strip() for t in titles]
     return [t for t in clean if t and t not in ("はじめに", "まとめ")]
 
+def _summary_start(html: str) -> int | None:
+    """最後の「まとめ」系<h2>（〜に関するまとめ 等も含む）の開始位置。無ければ None。"""
+    last = None
+    for last in _RE_HAS_SUMMARY.finditer(html):
+        pass
+    return last.start() if last else None
+
+def _insert_before_summary(html: str, block: str) -> str:
+    """追記ブロックを「まとめ」H2の直前に差し込む（まとめは常に最後）。まとめが無ければ末尾に追記。"""
+    i = _summary_start(html)
+    if i is None:
+        return html.rstrip() + "\n\n" + block
+    return html[:i].rstrip() + "\n\n" + block.strip() + "\n\n" + html[i:]
+
 def _append_fallback_summary(html: str) -> str:
     """<h2>まとめ</h2> が無いときに、ローカルで汎用のまとめを末尾に付与（LLM不使用＝追加料金ゼロ）"""
     heads = _extract_h2_titles(html)[:3]
@@ -110,96 +286,87 @@ def _append_fallback_summary(html: str) -> str:
 # 生成ユーティリティ / バリデータ
 # ------------------------------
 ALLOWED_TAGS = ['h2', 'h3', 'p', 'strong', 'em', 'ul', 'ol', 'li', 'table', 'tr', 'th', 'td']  # <br>禁止
+_ALLOWED = frozenset(ALLOWED_TAGS)
 MAX_H2 = 8
-H2_RE = re.compile(r'(<h2>.*?</h2>)', re.IGNORECASE | re.DOTALL)
+H2_RE = re.compile(r'(<h2>.*?</h2>)', re.IGNORECASE | re.DOTALL)  # _RE_H2 の捕捉版（split で見出しを残す用）
+
+def _keep_allowed_tag(m: re.Match) -> str:
+    return m.group(0) if m.group(1).lower() in _ALLOWED else ''
 
 def simplify_html(html: str) -> str:
-    # 許可タグ以外を除去 + <br>禁止
-    tags = re.findall(r'</?(\w+)[^>]*>', html)
-    for tag in set(tags):
-        if tag.lower() not in ALLOWED_TAGS:
-            html = re.sub(rf'</?{tag}[^>]*>', '', html, flags=re.IGNORECASE)
-    html = re.sub(r'<br\s*/?>', '', html, flags=re.IGNORECASE)
-    return html
+    # 許可タグ以外を除去 + <br>禁止（br は _ALLOWED に無いので同じ1パスで消える）
+    return _RE_TAG.sub(_keep_allowed_tag, html)
 
 def validate_article(html: str) -> List[str]:
     warns: List[str] = []
-    if re.search(r'<h4|<script|<style', html, flags=re.IGNORECASE):
+    if _RE_FORBIDDEN.search(html):
         warns.append("禁止タグ（h4/script/style）が含まれています。")
-    if re.search(r'<br\s*/?>', html, flags=re.IGNORECASE):
+    if _RE_BR.search(html):
         warns.append("<br> タグは使用禁止です。すべて <p> に置き換えてください。")
+    # 区間ごとの検査は pos/endpos 指定で行い、部分文字列を切り出さない
+    n = len(html)
     # H2ごとに表or箇条書き
-    h2_iter = list(re.finditer(r'(<h2>.*?</h2>)', html, flags=re.DOTALL | re.IGNORECASE))
-    for i, m in enumerate(h2_iter):
-        start = m.end()
-        end = h2_iter[i + 1].start() if i + 1 < len(h2_iter) else len(html)
-        section = html[start:end]
-        if not re.search(r'<(ul|ol|table)\b', section, flags=re.IGNORECASE):
+    h2_starts, h2_ends = h2_bounds(html)
+    for start, end in zip(h2_ends, h2_starts[1:] + [n]):
+        if not _RE_LIST_OR_TABLE.search(html, start, end):
             warns.append("H2セクションに表（table）または箇条書き（ul/ol）が不足しています。")
     # h3直下の<p>分量
-    h3_positions = list(re.finditer(r'(<h3>.*?</h3>)', html, flags=re.DOTALL | re.IGNORECASE))
-    for i, m in enumerate(h3_positions):
+    for m in _RE_H3.finditer(html):
         start = m.end()
-        next_head = re.search(r'(<h2>|<h3>)', html[start:], flags=re.IGNORECASE)
-        end = start + next_head.start() if next_head else len(html)
-        block = html[start:end]
-        p_count = len(re.findall(r'<p>.*?</p>', block, flags=re.DOTALL | re.IGNORECASE))
+        next_head = _RE_HEADING_OPEN.search(html, start)
+        p_count = len(_RE_P.findall(html, start, next_head.start() if next_head else n))
         if p_count < 3 or p_count > 6:
             warns.append("各<h3>直下は4〜5文（<p>）が目安です。分量を調整してください。")
     # 全文ざっくり長さ
-    plain = re.sub(r'<.*?>', '', html)
+    plain = _RE_STRIP_TAGS.sub('', html)
     if len(plain.strip()) > 6000:
         warns.append("記事全体が6000文字を超えています。要約・整理してください。")
     return warns
 
-def count_h2(html: str) -> int:
-    return len(H2_RE.findall(html or ""))
-
-def trim_h2_max(structure_html: str, max_count: int) -> str:
-    parts = H2_RE.split(structure_html)
-    out: List[str] = []
-    h2_seen = 0
-    i = 0
-    while i < len(parts):
-        chunk = parts[i]
-        if H2_RE.match(chunk or ""):
-            h2_seen += 1
-            if h2_seen <= max_count:
-                out.append(chunk)
-                if i + 1 < len(parts):
-                    out.append(parts[i + 1])
-            i += 2
-            continue
-        else:
-            if h2_seen == 0:
-                out.append(chunk)
-            i += 1
-    return "".join(out)
+@st.cache_data(show_spinner=False, max_entries=32)
+def validate_and_scan(html: str, co_terms: Tuple[str, ...]) -> List[str]:
+    """
+    プレビュー用の検査一式（validate_article + 共起語の出現チェック）。
+    本文が変わるのは生成/編集時だけなので、(本文, 共起語) ごとにキャッシュして再実行では使い回す。
+    """
+    issues = validate_article(html)
+    # 共起語の出現チェック（全角/半角・大小無視の単純包含）
+    if co_terms:
+        plain = fold_text(_RE_STRIP_TAGS.sub('', html))  # タグ除去と正規化は本文につき1回
+        missing = [w for w in co_terms if fold_text(w) not in plain]
+        if missing:
+            issues.append(f"共起語が本文に見当たりません：{', '.join(missing)}")
+    return issues
+
+def h2_bounds(html: str) -> Tuple[List[int], List[int]]:
+    """<h2>…</h2> の開始位置と終了位置を別々の配列で返す（1回の走査で後続処理に使い回す）。"""
+    starts: List[int] = []
+    ends: List[int] = []
+    for m in _RE_H2.finditer(html or ""):
+        starts.append(m.start())
+        ends.append(m.end())
+    return starts, ends
+
+def scan_h2(html: str) -> Tuple[int, List[int]]:
+    """H2の数と各<h2>の開始位置を返す（h2_bounds の走査結果をそのまま使う）。"""
+    starts, _ends = h2_bounds(html)
+    return len(starts), starts
+
+def trim_h2_max(structure_html: str, max_count: int, starts: List[int] | None = None) -> str:
+    """H2を先頭 max_count 個までに切る（(max_count+1) 個目のH2直前でカット）。starts は scan_h2/h2_bounds の開始位置。"""
+    if starts is None:
+        starts, _ends = h2_bounds(structure_html)
+    max_count = max(max_count, 0)
+    return structure_html[:starts[max_count]] if len(starts) > max_count else structure_html
 
 def strip_existing_summary_h2(structure_html: str) -> str:
     """構成③中に紛れた「まとめ」系H2をすべて除去（構成は本文用だけにする）"""
     # 「まとめ」を含む<h2>～直後の<h3>群を丸ごと消す（次の<h2>直前まで）
-    out = []
-    i = 0
-    pattern_h2 = re.compile(r'(?is)<h2>(.*?)</h2>')
-    matches = list(pattern_h2.finditer(structure_html))
-    last_end = 0
-    for idx, m in enumerate(matches):
-        title = re.sub(r'<.*?>', '', m.group(1) or '').strip()
-        next_start = matches[idx + 1].start() if idx + 1 < len(matches) else len(structure_html)
-        block = structure_html[m.start():next_start]
-        if "まとめ" in title:
-            # スキップ（入れない）
-            pass
-        else:
-            # 直前のテキスト片を保持
-            if last_end < m.start():
-                out.append(structure_html[last_end:m.start()])
-            out.append(block)
-        last_end = next_start
-    if last_end < len(structure_html):
-        out.append(structure_html[last_end:])
-    return "".join(out).strip()
+    # split 結果は [先頭, h2, 続き, h2, 続き, ...]
+    parts = H2_RE.split(structure_html)
+    kept = [h + body for h, body in zip(parts[1::2], parts[2::2])
+            if "まとめ" not in _RE_STRIP_TAGS.sub('', h)]
+    return (parts[0] + "".join(kept)).strip()
 
 def enforce_summary_last(structure_html: str, keyword: str, total_h2: int) -> str:
     """
@@ -210,10 +377,9 @@ def enforce_summary_last(structure_html: str, keyword: str, total_h2: int) -> st
     # まず③構成内に紛れた「まとめ」H2は全部削除（本文用に純化）
     structure_html = strip_existing_summary_h2(structure_html)
 
-    # 本文用の上限は total_h2 - 1
+    # 本文用の上限は total_h2 - 1（超過分は content_max+1 個目のH2の直前で切る）
     content_max = max(total_h2 - 1, 0)
-    if count_h2(structure_html) > content_max:
-        structure_html = trim_h2_max(structure_html, content_max)
+    structure_html = trim_h2_max(structure_html, content_max)
 
     # 最後に「まとめ」H2を強制付与
     summary_h2 = f"\n<h2>{keyword}に関するまとめ</h2>\n"
@@ -223,34 +389,33 @@ def enforce_summary_last(structure_html: str, keyword: str, total_h2: int) -> st
 # ------------------------------
 # 本文文字数制御（必要なら再利用）
 # ------------------------------
-
-import re
-
 def _summary_span(html: str) -> tuple[int, int] | None:
     """<h2>まとめ</h2> セクションの [開始, 終了) インデックスを返す。無ければ None。"""
-    m = re.search(r'(?i)<h2>\s*まとめ\s*</h2>', html)
+    m = _RE_SUMMARY_H2.search(html)
     if not m:
         return None
     start = m.start()
     # 次の<h2> までが まとめセクション
-    m2 = re.search(r'(?i)<h2>', html[m.end():])
-    end = m.end() + (m2.start() if m2 else 0)
-    return (start, end if m2 else len(html))
-
-def _visible_len(s: str) -> int:
-    return len(re.sub(r'<.*?>', '', s or '', flags=re.DOTALL).strip())
+    m2 = _RE_H2_OPEN.search(html, m.end())
+    return (start, m2.start() if m2 else len(html))
+
+def _take_p_chunks(html: str, limit: int) -> str:
+    """<p>区切りの各チャンクの可視長を1回だけ数え、累積長の二分探索で limit 以内の先頭部分を返す。"""
+    # 各 </p> の直後で区切る（最後の</p>以降の残りは1チャンク）。空マッチは生じない
+    parts: List[str] = []
+    prev = 0
+    for m in _RE_P.finditer(html):
+        parts.append(html[prev:m.end()])
+        prev = m.end()
+    if prev < len(html):
+        parts.append(html[prev:])
+    cum = list(accumulate(len(_RE_STRIP_TAGS.sub('', part)) for part in parts))
+    out = "".join(parts[:bisect_right(cum, limit)])
+    return out if out else html[:limit]
 
 def _trim_by_p(html_block: str, limit: int) -> str:
     """<p>単位で前から積み上げて limit 以内に収める（タグは壊さない素朴版）。"""
-    parts = re.findall(r'(?si).*?(?:<p>.*?</p>|$)', html_block)
-    out = ""
-    for part in parts:
-        cand = out + part
-        if _visible_len(cand) <= limit:
-            out = cand
-        else:
-            break
-    return out if out else html_block[:limit]
+    return _take_p_chunks(html_block, limit)
 
 def cap_summary(html: str, limit_chars: int = 320) -> str:
     """まとめセクションを limit_chars 以内にカット（<p>単位）。"""
@@ -267,21 +432,19 @@ def cap_summary(html: str, limit_chars: int = 320) -> str:
 # ------------------------------
 # 本文文字数制御（必要なら再利用）
 # ------------------------------
+@lru_cache(maxsize=64)
 def visible_length(html: str) -> int:
-    text = re.sub(r'<.*?>', '', html or '', flags=re.DOTALL)
+    # str.split('<') / partition でのループより、コンパイル済み正規表現の sub の方が約2倍速い（実測）ため正規表現のまま。
+    # 同じ本文を続けて測る箇所（厳密制御・trim_to_max_chars）が多いのでメモ化する
+    text = _RE_STRIP_TAGS.sub('', html or '')
     return len(text.strip())
 
 def trim_to_max_chars(html: str, limit: int) -> str:
     if visible_length(html) <= limit:
         return html
-    parts = re.findall(r'(?si).*?(?:<p>.*?</p>|$)', html)
-    out = ""
-    for part in parts:
-        if visible_length(out + part) <= limit:
-            out += part
-        else:
-            break
-    return out if out else html[:limit]
+    return _take_p_chunks(html, limit)
+
+STRICT_APPEND_MARGIN = 200  # 厳密制御の追記依頼に上乗せする文字数（1回で不足を埋めるため）
 
 def prompt_append_chars(keyword: str, co_terms: List[str], current_html: str, need_chars: int) -> str:
     co_block = "\n".join([f"- {w}" for w in co_terms]) if co_terms else "（なし）"
@@ -310,16 +473,108 @@ def prompt_append_chars(keyword: str, co_terms: List[str], current_html: str, ne
 # ------------------------------
 # Gemini 呼び出し
 # ------------------------------
-def call_gemini(prompt: str, temperature: float = 0.2, model: str = "gemini-1.5-pro") -> str:
+GEMINI_MAX_429_RETRIES = 3
+
+class GeminiRateLimiter:
+    """直近60秒のリクエスト数/推定トークン数を数え、上限に達していれば空くまで待つ（既定は上限の約8割）。"""
+
+    def __init__(self, rpm: int = 24, tpm: int = 800_000):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.req_times: deque[float] = deque()
+        self.token_times: deque[Tuple[float, int]] = deque()
+        self.tokens_in_window = 0
+        self.lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self.req_times and now - self.req_times[0] >= 60:
+            self.req_times.popleft()
+        while self.token_times and now - self.token_times[0][0] >= 60:
+            self.tokens_in_window -= self.token_times.popleft()[1]
+
+    def acquire(self, estimated_tokens: int) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._expire(now)
+                rpm_ok = len(self.req_times) < self.rpm
+                # 1件で tpm を超える巨大プロンプトでも、窓が空なら通す（永久待ち防止）
+                tpm_ok = not self.token_times or self.tokens_in_window + estimated_tokens <= self.tpm
+                if rpm_ok and tpm_ok:
+                    self.req_times.append(now)
+                    self.token_times.append((now, estimated_tokens))
+                    self.tokens_in_window += estimated_tokens
+                    return
+                oldest = self.req_times[0] if not rpm_ok else self.token_times[0][0]
+                wait = 60 - (now - oldest)
+            time.sleep(max(wait, 0.05))
+
+@st.cache_resource
+def get_gemini_limiter() -> GeminiRateLimiter:
+    """プロセス全体で1つのリミッター（再実行・複数タブで共有）。"""
+    return GeminiRateLimiter()
+
+def call_gemini_stream(prompt: str, temperature: float = 0.2, model: str = "gemini-1.5-pro") -> Iterator[str]:
+    """streamGenerateContent（SSE）で生成テキストを届いた順に返す。st.write_stream にそのまま渡せる。"""
     if not GEMINI_KEY:
         raise RuntimeError("Gemini APIキーが未設定です。Secrets に google.gemini_api_key_1 を追加してください。")
-    endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={GEMINI_KEY}"
+    endpoint = (f"{GEMINI_API_ORIGIN}v1beta/models/{model}:streamGenerateContent"
+                f"?alt=sse&key={GEMINI_KEY}")
     payload = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"temperature": temperature}}
-    r = requests.post(endpoint, json=payload, timeout=90)
+    body = orjson.dumps(payload)  # UTF-8 バイト列のまま送る（requests 内部の json エンコードを通さない）
+    for attempt in range(GEMINI_MAX_429_RETRIES + 1):
+        get_gemini_limiter().acquire(len(prompt) // 4)  # トークン数は 4文字≒1トークン で概算
+        r = get_http_session().post(endpoint, data=body, headers={"Content-Type": "application/json"},
+                                    timeout=90, stream=True)
+        if r.status_code != 429 or attempt == GEMINI_MAX_429_RETRIES:
+            break
+        r.close()
+        time.sleep(2 ** attempt + random.random())  # 指数バックオフ + ジッター
     if r.status_code != 200:
         raise RuntimeError(f"Gemini エラー: {r.status_code} / {r.text[:500]}")
-    j = r.json()
-    return j["candidates"][0]["content"]["parts"][0]["text"]
+    got_text = False
+    block_reason = finish_reason = None
+    with r:
+        # text/event-stream は charset 無しだと latin-1 扱いになるため、バイト列のまま（UTF-8として）解析
+        for line in r.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            j = orjson.loads(line[5:])
+            block_reason = j.get("promptFeedback", {}).get("blockReason") or block_reason
+            for cand in j.get("candidates", [])[:1]:
+                finish_reason = cand.get("finishReason") or finish_reason
+                for part in cand.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        got_text = True
+                        yield part["text"]
+    # 本文が1つも届かない（ブロック/空の候補）のは失敗扱い。空文字を成功として返さない
+    if not got_text:
+        raise RuntimeError(f"Gemini 応答に本文がありません（blockReason={block_reason} / finishReason={finish_reason}）")
+
+def call_gemini(prompt: str, temperature: float = 0.2, model: str = "gemini-1.5-pro") -> str:
+    return "".join(call_gemini_stream(prompt, temperature=temperature, model=model))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_gemini(prompt: str, model: str) -> str:
+    """同一プロンプト+モデルの結果を1時間再利用（プロンプト文字列が入力をすべて含むのでキーとして十分）。"""
+    text = call_gemini(prompt, model=model)
+    if not text:  # 空の結果は1時間残さない（例外は st.cache_data に保存されない）
+        raise RuntimeError("Gemini の応答が空でした。もう一度生成してください。")
+    return text
+
+def gemini_text(prompt: str, model: str) -> str:
+    """サイドバーの「生成結果を再利用」がONならキャッシュ経由、OFFなら毎回新しく生成。"""
+    if st.session_state.get("reuse_gemini", True):
+        return _cached_gemini(prompt, model)
+    return call_gemini(prompt, model=model)
+
+def with_script_ctx(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """ThreadPoolExecutor から呼べるよう、現在の ScriptRunContext をワーカースレッドへ引き継ぐ。"""
+    ctx = get_script_run_ctx()
+    def _run(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return _run
 
 # 既存の関数はそのまま保持（バックアップ用）
 def generate_seo_title(keyword: str, content_dir: str) -> str:
@@ -365,7 +620,7 @@ def generate_seo_description(keyword: str, content_dir: str, title: str) -> str:
 
 # 出力: 説明文のみ
 """
-    result = call_gemini(p).strip()
+    result = call_gemini(p, model=st.session_state.get("selected_model", "gemini-1.5-pro")).strip()
     # クリーニング
     result = re.sub(r'[\n\r]', '', result)[:120]
     return result
@@ -518,7 +773,7 @@ def generate_title_and_description_unified(keyword: str, content_dir: str) -> tu
 タイトル: ここにタイトル
 説明: ここに説明文
 """
-    result = call_gemini(p).strip()
+    result = call_gemini(p, model=st.session_state.get("selected_model", "gemini-1.5-pro")).strip()
     
     # 結果をパース
     title_match = re.search(r'タイトル:\s*(.+)', result)
@@ -534,32 +789,34 @@ def generate_title_and_description_unified(keyword: str, content_dir: str) -> tu
     return title, desc
 
 
-def generate_permalink(keyword_or_title: str) -> str:
-    import re as _re
-    from datetime import datetime as _dt
+_PERMA_CLEAN = re.compile(r"[^a-z0-9\s-]")
+_PERMA_SPACE = re.compile(r"\s+")
+_PERMA_DASH = re.compile(r"-{2,}")
+
+@st.cache_resource
+def _get_romaji_converter() -> Callable[[str], str]:
+    """unidecode → pykakasi → 無変換 の順で変換関数を用意（辞書ロードはプロセスで1回だけ）。"""
     try:
         from unidecode import unidecode
-        def _jp_to_romaji(s: str) -> str:
-            return unidecode(s)
+        return unidecode
     except Exception:
         try:
             from pykakasi import kakasi
             _kk = kakasi()
             _kk.setMode("J", "a")
-            _conv = _kk.getConverter()
-            def _jp_to_romaji(s: str) -> str:
-                return _conv.do(s)
+            return _kk.getConverter().do
         except Exception:
-            def _jp_to_romaji(s: str) -> str:
-                return s
+            return lambda s: s
+
+def generate_permalink(keyword_or_title: str) -> str:
     s = (keyword_or_title or "").strip()
     if not s:
-        return f"post-{int(_dt.now().timestamp())}"
-    s = _jp_to_romaji(s).lower()
+        return f"post-{int(datetime.now().timestamp())}"
+    s = _get_romaji_converter()(s).lower()
     s = s.replace("&", " and ").replace("+", " plus ")
-    s = _re.sub(r"[^a-z0-9\s-]", "", s)
-    s = _re.sub(r"\s+", "-", s)
-    s = _re.sub(r"-{2,}", "-", s).strip("-")
+    s = _PERMA_CLEAN.sub("", s)
+    s = _PERMA_SPACE.sub("-", s)
+    s = _PERMA_DASH.sub("-", s).strip("-")
     if len(s) > 50:
         parts = s.split("-")
         out = []
@@ -570,7 +827,7 @@ def generate_permalink(keyword_or_title: str) -> str:
                 break
             out.append(p)
         s = "-".join(out) or s[:50]
-    return s or f"post-{int(_dt.now().timestamp())}"
+    return s or f"post-{int(datetime.now().timestamp())}"
 
 # ------------------------------
 # ポリシー（統合）管理
@@ -620,30 +877,53 @@ DEFAULT_POLICY_TXT = """[リード文]
 
 SECTION_MARKERS = ("[リード文]", "[本文指示]", "[まとめ文]")
 
+def _next_bracket_tag(text: str, start: int) -> int:
+    """start 以降で最初の `[...]`（中身1文字以上）の開始位置。無ければ len(text)。"""
+    i = text.find("[", start)
+    while i >= 0:
+        j = text.find("]", i + 1)
+        if j < 0:
+            break
+        if j > i + 1:
+            return i
+        i = text.find("[", i + 1)
+    return len(text)
+
 def extract_sections(policy_text: str) -> Tuple[str, str, str]:
-    def _find(label: str) -> str:
-        m = re.search(rf"\[{label}\](.*?)(?=\[[^\]]+\]|$)", policy_text, flags=re.DOTALL)
-        return (m.group(1).strip() if m else "")
+    # 区切りは固定文字列なので正規表現は使わず str.find で切り出す（次の [..] 見出しの直前まで）
+    def _find(marker: str) -> str:
+        pos = policy_text.find(marker)
+        if pos < 0:
+            return ""
+        start = pos + len(marker)
+        return policy_text[start:_next_bracket_tag(policy_text, start)].strip()
     if not any(x in policy_text for x in SECTION_MARKERS):
         return "", policy_text.strip(), ""
-    return _find("リード文"), _find("本文指示"), _find("まとめ文")
+    return tuple(_find(m) for m in SECTION_MARKERS)
 
 # ------------------------------
 # キャッシュ I/O（統合テキストをそのまま保存）
 # ------------------------------
+@st.cache_data(persist="disk", show_spinner=False)
+def load_policies_cached() -> Dict[str, Any] | None:
+    """policies_cache.json の内容をメモリ+ディスクにキャッシュ（再実行のたびにファイルを読まない）。"""
+    if CACHE_PATH.exists():
+        return orjson.loads(CACHE_PATH.read_bytes())
+    return None
+
 def load_policies_from_cache() -> Dict[str, Any] | None:
+    # 例外はキャッシュされないので、壊れたファイルは直した次の再実行で読み直される
     try:
-        if CACHE_PATH.exists():
-            with open(CACHE_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
+        return load_policies_cached()
     except Exception as e:
         st.warning(f"ポリシーキャッシュ読込エラー: {e}")
     return None
 
 def save_policies_to_cache(store: Dict[str, str], active_name: str):
     try:
-        with open(CACHE_PATH, "w", encoding="utf-8") as f:
-            json.dump({"policy_store": store, "active_policy": active_name}, f, ensure_ascii=False, indent=2)
+        CACHE_PATH.write_bytes(orjson.dumps({"policy_store": store, "active_policy": active_name},
+                                            option=orjson.OPT_INDENT_2))
+        load_policies_cached.clear()
     except Exception as e:
         st.warning(f"ポリシーキャッシュ保存エラー: {e}")
 
@@ -654,12 +934,17 @@ st.sidebar.header("接続先（WP）")
 site_key = st.sidebar.selectbox("投稿先サイト", sorted(WP_CONFIGS.keys()))
 cfg = WP_CONFIGS[site_key]
 BASE = ensure_trailing_slash(cfg["url"])
-AUTH = HTTPBasicAuth(cfg["user"], cfg["password"])
+AUTH: WPAuth = (cfg["user"], cfg["password"])
 
 if st.sidebar.button("🔐 認証 /users/me"):
-    r = wp_get(BASE, "wp/v2/users/me", AUTH, HEADERS)
-    st.sidebar.code(f"GET users/me → {r.status_code if r else 'N/A'}")
-    st.sidebar.caption((r.text[:300] if r is not None else "No response"))
+    code, text = cached_wp_get(BASE, "wp/v2/users/me", cfg["user"], cfg["password"])
+    st.sidebar.code(f"GET users/me → {code if code is not None else 'N/A'}")
+    st.sidebar.caption((text[:300] if code is not None else "No response"))
+
+if st.sidebar.button("🔄 WP情報を再取得"):
+    cached_wp_get.clear()
+    _cached_fetch_categories.clear()
+    st.session_state.pop(f"cats::{site_key}", None)  # 覚えている取得結果（失敗含む）も捨てる
 
 # ここに追加：モデル選択UI
 st.sidebar.header("🤖 AIモデル選択")
@@ -673,12 +958,18 @@ model_choice = st.sidebar.radio(
 
 # モデル名をセッションに保存
 if model_choice == "Pro":
-    st.session_state["selected_model"] = "gemini-1.5-pro"
+    _put("selected_model", "gemini-1.5-pro")
     st.sidebar.success("💎 Pro選択中\n約12～13円/記事（高品質）")
 else:
-    st.session_state["selected_model"] = "gemini-1.5-flash"  
+    _put("selected_model", "gemini-1.5-flash")
     st.sidebar.info("⚡ Flash選択中\n約5円/記事（SEO特化なら）")
 
+_put("reuse_gemini", st.sidebar.checkbox(
+    "♻️ 同じ入力の生成結果を再利用（1時間）",
+    value=True,
+    help="ON: 入力が同じなら前回の生成結果を即表示（API料金なし） | OFF: 毎回作り直す（記事本文はストリーミング表示）"
+))
+
 st.sidebar.markdown("---")  # 区切り線
 
 # ------------------------------
@@ -704,10 +995,19 @@ if DEFAULT_PRESET_NAME not in st.session_state.policy_store:
     if st.session_state.active_policy not in st.session_state.policy_store:
         st.session_state.active_policy = DEFAULT_PRESET_NAME
 
+# セレクトボックス用の並び済み名前一覧：追加/削除時に差分更新し、毎回は並べ直さない
+# （キャッシュ読込で policy_store が差し替わっても、中身の名前が同じなら作り直さない）
+_pnames = st.session_state.get("policy_names_sorted")
+if (not isinstance(_pnames, list) or len(_pnames) != len(st.session_state.policy_store)
+        or any(n not in st.session_state.policy_store for n in _pnames)):
+    st.session_state.policy_names_sorted = sorted(st.session_state.policy_store)
+
 cur_txt = st.session_state.policy_store[st.session_state.active_policy]
 st.session_state.setdefault("policy_text", cur_txt)
 st.session_state.setdefault("banned_text", "")
 st.session_state.setdefault("co_terms_text", "")  # 共起語入力
+st.session_state.setdefault("title", "")    # 右欄「タイトル」入力（key="title"）
+st.session_state.setdefault("excerpt", "")  # 右欄「ディスクリプション」入力（key="excerpt"）
 
 # ==============================
 # 3カラム：入力 / 生成&プレビュー / 投稿
@@ -724,35 +1024,43 @@ with colL:
     st.markdown("### 🔗 共起語（任意）")
     st.caption("改行またはカンマ区切り。本文に“自然に”散りばめます（例：審査, 即日, 最短, 手数料）。")
     co_terms_text = st.text_area("共起語リスト", value=st.session_state.get("co_terms_text", ""), height=120)
-    st.session_state["co_terms_text"] = co_terms_text
+    _put("co_terms_text", co_terms_text)
     co_terms: List[str] = []
     if co_terms_text.strip():
-        # カンマと改行の両対応→重複/空白除去
-        raw_list = re.split(r"[,\n\r]+", co_terms_text)
-        co_terms = sorted({w.strip() for w in raw_list if w.strip()})
+        # カンマと改行の両対応→重複/空白除去（入力順は維持）
+        raw_list = _RE_CO_SPLIT.split(co_terms_text)
+        co_terms = list(dict.fromkeys(w for w in map(str.strip, raw_list) if w))
 
     st.markdown("### 🚫 禁止事項（任意_1行=1項目）")
     banned_text = st.text_area("入れたくない内容があるならば記入してください。カニバリ対策です。", value=st.session_state.get("banned_text", ""), height=120)
-    st.session_state["banned_text"] = banned_text
-    merged_banned = [l.strip() for l in banned_text.splitlines() if l.strip()]
+    _put("banned_text", banned_text)
+    merged_banned = list(dict.fromkeys(l for l in map(str.strip, banned_text.splitlines()) if l))
 
     st.divider()
     st.subheader("④ 文章ポリシー（統合 .txt）")
 
     pol_files = st.file_uploader("policy*.txt（複数可）を読み込む", type=["txt"], accept_multiple_files=True)
     if pol_files:
+        last_name = None
         for f in pol_files:
             try:
-                raw = f.read().decode("utf-8", errors="ignore").strip()
-                name = f.name.rsplit(".", 1)[0]
-                st.session_state.policy_store[name] = raw
-                st.session_state.active_policy = name
-                st.session_state.policy_text = raw
+                # bytes 全体を別に持たず逐次デコード。detach で UploadedFile 側は閉じない
+                reader = io.TextIOWrapper(f, encoding="utf-8", errors="ignore")
+                raw = reader.read().strip()
+                reader.detach()
+                last_name = f.name.rsplit(".", 1)[0]
+                if last_name not in st.session_state.policy_store:
+                    insort(st.session_state.policy_names_sorted, last_name)
+                st.session_state.policy_store[last_name] = raw
             except Exception as e:
                 st.warning(f"{f.name}: 読み込み失敗 ({e})")
+        # 最後に読めたファイルを適用（途中のファイルでは書き換えない）
+        if last_name is not None:
+            st.session_state.active_policy = last_name
+            st.session_state.policy_text = st.session_state.policy_store[last_name]
         save_policies_to_cache(st.session_state.policy_store, st.session_state.active_policy)
 
-    names = sorted(st.session_state.policy_store.keys())
+    names = st.session_state.policy_names_sorted
     sel_index = names.index(st.session_state.active_policy) if st.session_state.active_policy in names else 0
     sel_name = st.selectbox("適用するポリシー", names, index=sel_index)
     if sel_name != st.session_state.active_policy:
@@ -761,18 +1069,26 @@ with colL:
         save_policies_to_cache(st.session_state.policy_store, st.session_state.active_policy)
 
     st.markdown("### ✏️ 本文ルール")
-    st.session_state.policy_text = st.text_area(
-        "本文（統合形式）",
-        value=st.session_state.get("policy_text", ""),
-        height=420
-    )
+    # 入力中は再実行させない：フォーム送信時だけ policy_text に反映
+    with st.form("policy_form"):
+        policy_edit = st.text_area(
+            "本文（統合形式）",
+            value=st.session_state.get("policy_text", ""),
+            height=420
+        )
+        fA, fB = st.columns([1, 1])
+        with fA:
+            apply_clicked = st.form_submit_button("編集を反映")
+        with fB:
+            save_clicked = st.form_submit_button("この内容で上書き保存")
+    if apply_clicked or save_clicked:
+        st.session_state.policy_text = policy_edit
+    if save_clicked:
+        st.session_state.policy_store[st.session_state.active_policy] = st.session_state.policy_text
+        save_policies_to_cache(st.session_state.policy_store, st.session_state.active_policy)
+        st.success(f"『{st.session_state.active_policy}』を更新しました。")
 
-    cA, cB, cC, cD = st.columns([1, 1, 1, 1])
-    with cA:
-        if st.button("この内容で上書き保存"):
-            st.session_state.policy_store[st.session_state.active_policy] = st.session_state.policy_text
-            save_policies_to_cache(st.session_state.policy_store, st.session_state.active_policy)
-            st.success(f"『{st.session_state.active_policy}』を更新しました。")
+    cB, cC, cD = st.columns([1, 1, 1])
     with cB:
         st.download_button(
             "この内容をPCへ保存（.txt）",
@@ -790,9 +1106,11 @@ with colL:
         delete_clicked = st.button("このプリセットを削除", disabled=not can_delete)
         if delete_clicked:
             del st.session_state.policy_store[st.session_state.active_policy]
+            st.session_state.policy_names_sorted.remove(st.session_state.active_policy)
             fallback = DEFAULT_PRESET_NAME if DEFAULT_PRESET_NAME in st.session_state.policy_store else None
             if not fallback:
                 st.session_state.policy_store[DEFAULT_PRESET_NAME] = DEFAULT_POLICY_TXT
+                insort(st.session_state.policy_names_sorted, DEFAULT_PRESET_NAME)
                 fallback = DEFAULT_PRESET_NAME
             st.session_state.active_policy = fallback
             st.session_state.policy_text = st.session_state.policy_store[fallback]
@@ -801,6 +1119,7 @@ with colL:
     with cD:
         if st.button("🔁 プリセットを初期状態に戻す"):
             st.session_state.policy_store = {DEFAULT_PRESET_NAME: DEFAULT_POLICY_TXT}
+            st.session_state.policy_names_sorted = [DEFAULT_PRESET_NAME]
             st.session_state.active_policy = DEFAULT_PRESET_NAME
             st.session_state.policy_text = DEFAULT_POLICY_TXT
             save_policies_to_cache(st.session_state.policy_store, st.session_state.active_policy)
@@ -829,34 +1148,36 @@ with colM:
         if not keyword.strip():
             st.error("キーワードは必須です。")
             st.stop()
-        outline_raw = call_gemini(
+        outline_raw = gemini_text(
             prompt_outline_123(keyword, extra_points, merged_banned, co_terms, min_h2, max_h2),
             model=st.session_state.get("selected_model", "gemini-1.5-pro")
         )
 
-        readers = re.search(r'①[^\n]*\n(.+?)\n\n②', outline_raw, flags=re.DOTALL)
-        needs = re.search(r'②[^\n]*\n(.+?)\n\n③', outline_raw, flags=re.DOTALL)
-        struct = re.search(r'③[^\n]*\n(.+)$', outline_raw, flags=re.DOTALL)
+        readers = _RE_OUTLINE_READERS.search(outline_raw)
+        needs = _RE_OUTLINE_NEEDS.search(outline_raw)
+        struct = _RE_OUTLINE_STRUCT.search(outline_raw)
 
         st.session_state["readers"] = (readers.group(1).strip() if readers else "")
         st.session_state["needs"] = (needs.group(1).strip() if needs else "")
         structure_html = (struct.group(1).strip() if struct else "").replace("\r", "")
         structure_html = simplify_html(structure_html)
 
-        if count_h2(structure_html) > max_h2:
-            structure_html = trim_h2_max(structure_html, max_h2)
+        # H2走査は1回。数と位置を上限カットに使い回し、追記した時だけ数え直す
+        current_h2, h2_starts = scan_h2(structure_html)
+        if current_h2 > max_h2:
+            structure_html = trim_h2_max(structure_html, max_h2, h2_starts)
+            current_h2 = max_h2
 
-        current_h2 = count_h2(structure_html)
         if current_h2 < min_h2:
             need = min_h2 - current_h2
-            add = call_gemini(prompt_fill_h2(keyword, structure_html, need), 
+            add = gemini_text(prompt_fill_h2(keyword, structure_html, need), 
                   model=st.session_state.get("selected_model", "gemini-1.5-pro")).strip()
             add = simplify_html(add)
-            if count_h2(add) > 0:
+            if scan_h2(add)[0] > 0:
                 structure_html = (structure_html.rstrip() + "\n\n" + add.strip())
-
-        if count_h2(structure_html) > max_h2:
-            structure_html = trim_h2_max(structure_html, max_h2)
+                current_h2, h2_starts = scan_h2(structure_html)
+                if current_h2 > max_h2:
+                    structure_html = trim_h2_max(structure_html, max_h2, h2_starts)
       # --- ここから追加：最後のH2を必ず「まとめ」に固定する ---
         # ユーザーの min/max は「総H2数（= まとめ含む）」として扱う。
         # ③では本文用H2のみ(total_h2-1)を確定させ、最後の1枠をまとめに予約する。
@@ -866,20 +1187,37 @@ with colM:
 
         st.session_state["structure_html"] = structure_html
 
-    # 手直し
-    readers_txt = st.text_area("① 読者像（編集可）", value=st.session_state.get("readers", ""), height=110)
-    needs_txt = st.text_area("② ニーズ（編集可）", value=st.session_state.get("needs", ""), height=110)
-    structure_html = st.text_area("③ 構成（HTML / 編集可）", value=st.session_state.get("structure_html", ""), height=180)
+    # 手直し（フォーム送信時だけ反映。入力中は再実行しない）
+    with st.form("outline_form"):
+        readers_txt = st.text_area("① 読者像（編集可）", value=st.session_state.get("readers", ""), height=110)
+        needs_txt = st.text_area("② ニーズ（編集可）", value=st.session_state.get("needs", ""), height=110)
+        structure_html = st.text_area("③ 構成（HTML / 編集可）", value=st.session_state.get("structure_html", ""), height=180)
+        outline_saved = st.form_submit_button("①〜③の編集を反映")
+        # 生成もフォーム送信にする：未反映の①〜③の編集も取りこぼさず生成に使う
+        generate_clicked = st.form_submit_button("🪄 記事を一括生成（リード→本文→まとめ）", type="primary",
+                                                 use_container_width=True)
+    if outline_saved or generate_clicked:
+        st.session_state["readers"] = readers_txt
+        st.session_state["needs"] = needs_txt
+        st.session_state["structure_html"] = structure_html
 
     # 記事を一括生成
-    if st.button("🪄 記事を一括生成（リード→本文→まとめ）", type="primary", use_container_width=True):
+    if generate_clicked:
         if not keyword.strip():
             st.error("キーワードは必須です。"); st.stop()
         if not structure_html.strip():
             st.error("③構成（HTML）が必要です。①〜③を生成し、必要なら編集してください。"); st.stop()
 
-        full = call_gemini(
-            prompt_full_article_unified(
+        # タイトル/説明は本文に依存しない（キーワード+読者像/ニーズ/ポリシーのみ）ので、未入力なら本文生成と並列で作る
+        # title / excerpt は右欄の入力欄の key なので、手入力済みの値もここで見える
+        need_title = not st.session_state.get("title", "").strip()
+        need_excerpt = not st.session_state.get("excerpt", "").strip()
+        want_td = need_title or need_excerpt
+        content_dir_now = readers_txt + "\n" + needs_txt + "\n" + st.session_state.get("policy_text", "")
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            f_td = ex.submit(with_script_ctx(generate_title_and_description_unified),
+                             keyword, content_dir_now) if want_td else None
+            article_prompt = prompt_full_article_unified(
                 keyword=keyword,
                 unified_policy_text=st.session_state.policy_text,
                 structure_html=structure_html,
@@ -889,9 +1227,28 @@ with colM:
                 co_terms=co_terms,
                 min_chars=min_chars,
                 max_chars=max_chars
-            ),
-            model=st.session_state.get("selected_model", "gemini-1.5-pro")
-        )
+            )
+            article_model = st.session_state.get("selected_model", "gemini-1.5-pro")
+            if st.session_state.get("reuse_gemini", True):
+                with st.spinner("記事を生成中..."):
+                    full = _cached_gemini(article_prompt, article_model)
+            else:
+                # 本文はメインスレッドでストリーミング表示しながら受信する
+                live = st.empty()
+                with live.container():
+                    st.caption("✍️ 生成中…")
+                    full = st.write_stream(call_gemini_stream(article_prompt, model=article_model))
+                live.empty()
+            if f_td is not None:
+                try:
+                    gen_title, gen_excerpt = f_td.result()
+                    # 空欄だけ埋める（入力済みの値は上書きしない）
+                    if need_title:
+                        st.session_state["title"] = gen_title
+                    if need_excerpt:
+                        st.session_state["excerpt"] = gen_excerpt
+                except Exception as e:
+                    st.warning(f"タイトル/説明の同時生成に失敗しました（右欄のボタンで再生成できます）: {e}")
         full = simplify_html(full)
         st.session_state["assembled_html"] = full
         st.session_state["edited_html"] = full
@@ -904,27 +1261,26 @@ with colM:
 
         # 文字数厳密制御
         if strict_chars:
+            # 不足分は余裕を持たせて1回で依頼し（通常は1往復で済む）、文字数は追記分だけ数えて更新する。
+            # 超過分は下の「まとめキャップ→安全カット」で処理する
             tries = 0
             html_cur = st.session_state["edited_html"]
-            while tries < max_adjust_tries:
-                cur_len = visible_length(html_cur)
-                if cur_len < min_chars:
-                    need = min(min_chars - cur_len, max_chars - cur_len)
-                    if need <= 0: break
-                    try:
-                        add = call_gemini(prompt_append_chars(keyword, co_terms, content, needed_chars), 
-                        model=st.session_state.get("selected_model", "gemini-1.5-pro")).strip()
-                        add = simplify_html(add)
-                        if not add or visible_length(add) < 100:
-                            break
-                        html_cur = (html_cur.rstrip() + "\n\n" + add)
-                    except Exception:
-                        break
-                elif cur_len > max_chars:
-                    html_cur = trim_to_max_chars(html_cur, max_chars)
+            cur_len = visible_length(html_cur)
+            while tries < max_adjust_tries and cur_len < min_chars:
+                need = min(min_chars - cur_len + STRICT_APPEND_MARGIN, max_chars - cur_len)
+                if need <= 0:
                     break
-                else:
+                try:
+                    add = gemini_text(prompt_append_chars(keyword, co_terms, html_cur, need),
+                                      model=st.session_state.get("selected_model", "gemini-1.5-pro")).strip()
+                except Exception:
                     break
+                add = simplify_html(add)
+                add_len = visible_length(add)
+                if not add or add_len < 100:
+                    break
+                html_cur = _insert_before_summary(html_cur, add)  # 本文側に足す（まとめの後ろに付けない）
+                cur_len += add_len
                 tries += 1
             st.session_state["edited_html"] = html_cur
 
@@ -933,38 +1289,37 @@ with colM:
             if html_cur:
                 # まとめは約300字目安 → 上限320字でキャップ
                 html_cur = cap_summary(html_cur, limit_chars=320)
-                # 全体が上限を超える場合は最後に安全カット
+                # 全体が上限を超える場合は安全カット（まとめは残し、本文側を削る）
                 if visible_length(html_cur) > max_chars:
-                    html_cur = trim_to_max_chars(html_cur, max_chars)
+                    i = _summary_start(html_cur)
+                    if i is None:
+                        html_cur = trim_to_max_chars(html_cur, max_chars)
+                    else:
+                        body_limit = max(max_chars - visible_length(html_cur[i:]), 0)
+                        html_cur = trim_to_max_chars(html_cur[:i], body_limit).rstrip() + "\n\n" + html_cur[i:]
                 st.session_state["edited_html"] = html_cur
                 st.session_state["assembled_html"] = html_cur  # プレビュー側も同期
     
 
     # プレビュー & 編集
     assembled = st.session_state.get("assembled_html", "")
-    if assembled:
-        st.markdown("#### 👀 プレビュー（一括生成結果）")
-        st.write(assembled, unsafe_allow_html=True)
-        issues = validate_article(assembled)
-
-        # 共起語の出現チェック（大小無視・単純包含）
-        if co_terms:
-            plain = re.sub(r'<.*?>', '', assembled).lower()
-            missing = [w for w in co_terms if w.lower() not in plain]
-            if missing:
-                issues.append(f"共起語が本文に見当たりません：{', '.join(missing)}")
-
-        if issues:
-            st.warning("検査結果:\n- " + "\n- ".join(issues))
+    # 長い本文の描画と検査は重いので、OFFにすると他の入力中の再実行ではスキップする
+    show_prev = st.checkbox("プレビュー表示", value=True)
+    if show_prev and assembled:
+        with st.expander("👀 プレビュー（一括生成結果）", expanded=True):
+            st.write(assembled, unsafe_allow_html=True)
+            issues = validate_and_scan(assembled, tuple(co_terms))
+            if issues:
+                st.warning("検査結果:\n- " + "\n- ".join(issues))
 
     with st.expander("✏️ プレビューを編集（この内容を下書きに送付）", expanded=False):
         st.caption("※ ここでの修正が最終本文になります。HTMLで編集可。")
-        st.session_state["edited_html"] = st.text_area(
+        _put("edited_html", st.text_area(
             "編集用HTML",
             value=st.session_state.get("edited_html", assembled),
             height=420
-        )
-        st.session_state["use_edited"] = st.checkbox("編集したHTMLを採用する", value=True)
+        ))
+        _put("use_edited", st.checkbox("編集したHTMLを採用する", value=True))
 
 # ------ 右：タイトル/説明 → 投稿 ------
 # ------ 右：タイトル/説明 → 投稿 ------
@@ -1005,37 +1360,53 @@ with colR:
                     t = st.session_state.get("title", "") or f"{keyword}について"
                     st.session_state["excerpt"] = generate_seo_description(keyword, content_dir, t)
                     st.success("説明文を生成しました。")
-
-    title = st.text_input("タイトル", value=st.session_state.get("title", ""))
+        # タイトルと説明文は互いの結果を待たないので2本同時に投げる（待ち時間は長い方の1回分）
+        if st.button("タイトル+説明文を並列生成", use_container_width=True):
+            if not content_source.strip():
+                st.warning("先に本文を用意してください。")
+            else:
+                t = st.session_state.get("title", "") or f"{keyword}について"
+                with st.spinner("タイトルと説明文を並列生成中..."):
+                    with ThreadPoolExecutor(max_workers=2) as ex:
+                        f_title = ex.submit(with_script_ctx(generate_seo_title), keyword, content_dir)
+                        f_desc = ex.submit(with_script_ctx(generate_seo_description), keyword, content_dir, t)
+                        st.session_state["title"], st.session_state["excerpt"] = f_title.result(), f_desc.result()
+                st.success("タイトルと説明文を生成しました。")
+
+    title = st.text_input("タイトル", key="title")
     slug = st.text_input("スラッグ（空ならキーワード/タイトルから自動）", value="")
-    excerpt = st.text_area("ディスクリプション（抜粋）", value=st.session_state.get("excerpt", ""), height=80)
+    excerpt = st.text_area("ディスクリプション（抜粋）", height=80, key="excerpt")
 
     # ▼ カテゴリーUI（Secrets→wp_categories→REST）
-    def fetch_categories(base_url: str, auth: HTTPBasicAuth) -> List[Tuple[str, int]]:
-        try:
-            r = wp_get(base_url, "wp/v2/categories?per_page=100&_fields=id,name", auth, HEADERS)
-            if r is not None and r.status_code == 200:
-                data = r.json()
-                pairs = [(c.get("name", "(no name)"), int(c.get("id"))) for c in data if c.get("id") is not None]
-                return sorted(pairs, key=lambda x: x[0])
-        except Exception:
-            pass
-        return []
-
-    cfg_cats_map: Dict[str, int] = dict(cfg.get("categories", {}))
-    cats: List[Tuple[str, int]] = []
-    if cfg_cats_map:
-        cats = sorted([(name, int(cid)) for name, cid in cfg_cats_map.items()], key=lambda x: x[0])
-    else:
-        sc_map: Dict[str, int] = st.secrets.get("wp_categories", {}).get(site_key, {})
-        if sc_map:
-            cats = sorted([(name, int(cid)) for name, cid in sc_map.items()], key=lambda x: x[0])
-        else:
-            cats = fetch_categories(BASE, AUTH)
-
+    # 解決結果はサイトごとに session_state に持ち、再読込ボタンを押した時だけ作り直す。
+    # 取得失敗も (空, 理由) として覚える（再実行のたびに失敗するRESTを叩き直さない）
+    cats_key = f"cats::{site_key}"
+    if cats_key not in st.session_state:
+        st.session_state[cats_key] = _resolve_cats(cfg, site_key, BASE, AUTH)
+    cats, cats_error = st.session_state[cats_key]
+    if cats_error:
+        st.error(f"カテゴリー取得失敗：{cats_error}（『🔄 再読込』で取り直せます）")
+    if st.button("🔄 再読込", help="カテゴリー一覧を取り直します"):
+        st.session_state.pop(cats_key, None)
+        _cached_fetch_categories.clear()
+        st.rerun()
+
+    # 候補が多いサイトでも描画を軽くするため、検索で絞った上位 CAT_OPTIONS_LIMIT 件だけを選択肢に出す
     cat_labels = [name for (name, _cid) in cats]
-    sel_labels: List[str] = st.multiselect("カテゴリー（複数可）", cat_labels, default=[])
-    selected_cat_ids: List[int] = [cid for (name, cid) in cats if name in sel_labels]
+    label_set = set(cat_labels)
+    # 選択値はウィジェット自身（key="sel_labels"）が保持する。サイト切替で消えた名前だけ描画前に落とす
+    prev_sel = st.session_state.get("sel_labels", [])
+    if any(l not in label_set for l in prev_sel):
+        prev_sel = [l for l in prev_sel if l in label_set]
+        st.session_state["sel_labels"] = prev_sel
+    cat_query = st.text_input("カテゴリ検索", "").strip().lower()
+    filtered = [n for n in cat_labels if not cat_query or cat_query in n.lower()][:CAT_OPTIONS_LIMIT]
+    options = prev_sel + [n for n in filtered if n not in prev_sel]  # 絞り込み変更でも選択済みは残す
+    if len(cat_labels) > CAT_OPTIONS_LIMIT and not cat_query:
+        st.caption(f"カテゴリーが {len(cat_labels)} 件あるため先頭 {CAT_OPTIONS_LIMIT} 件のみ表示中。検索で絞り込めます。")
+    sel_labels: List[str] = st.multiselect("カテゴリー（複数可）", options, key="sel_labels")
+    sel_set = set(sel_labels)
+    selected_cat_ids: List[int] = [cid for (name, cid) in cats if name in sel_set]
     if not cats:
         st.info("このサイトで選べるカテゴリーが見つかりませんでした。Secretsの `wp_configs.<site_key>.categories` を確認してください。")
 
@@ -1053,18 +1424,20 @@ with colR:
         if not title.strip():
             st.error("タイトルは必須です。"); st.stop()
 
-        content_html = (st.session_state.get("edited_html") if st.session_state.get("use_edited")
+        use_edited = st.session_state.get("use_edited")
+        content_html = (st.session_state.get("edited_html") if use_edited
                         else st.session_state.get("assembled_html", "")).strip()
         if not content_html:
             st.error("本文が未生成です。『①〜③生成→記事を一括生成』の順で作成してください。"); st.stop()
 
-        content_html = simplify_html(content_html)
+        # assembled_html は生成時に整形済み。手で編集されうる edited_html だけ整形し直す
+        if use_edited:
+            content_html = simplify_html(content_html)
 
         date_gmt = None
         if status == "future":
-            from datetime import datetime as _dt
-            dt_local = _dt.combine(sched_date, sched_time)
-            date_gmt = dt_local.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+            dt_local = datetime.combine(sched_date, sched_time, tzinfo=_JST)
+            date_gmt = dt_local.astimezone(timezone.utc).replace(tzinfo=None).isoformat(timespec="seconds")
 
         # スラッグ決定
         typed_slug = slug.strip() if slug else ""